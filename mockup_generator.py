@@ -1,5 +1,5 @@
 import streamlit as st
-from PIL import Image
+from PIL import Image, features
 import numpy as np
 import zipfile
 import io
@@ -8,6 +8,8 @@ import os
 import tempfile
 import atexit
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 st.set_page_config(page_title="Shirt Mockup Generator", layout="centered")
 st.title("👕 Shirt Mockup Generator with Batching")
@@ -22,6 +24,13 @@ plain_padding_ratio = st.sidebar.slider("Padding Ratio – Plain Shirt", 0.1, 1.
 model_padding_ratio = st.sidebar.slider("Padding Ratio – Model Shirt", 0.1, 1.0, 0.45, 0.05)
 plain_offset_pct = st.sidebar.slider("Vertical Offset – Plain Shirt (%)", -50, 100, 24, 1)
 model_offset_pct = st.sidebar.slider("Vertical Offset – Model Shirt (%)", -50, 100, 38, 1)
+# WebP is only offered when this Pillow build includes the codec
+output_formats = ["PNG", "WEBP"] if features.check("webp") else ["PNG"]
+output_format = st.sidebar.radio(
+    "Mockup File Format",
+    output_formats,
+    format_func=lambda f: "WebP (lossless, faster)" if f == "WEBP" else "PNG (widest compatibility)"
+)
 
 # --- Disk Space Check ---
 total, used, free = shutil.disk_usage("/")
@@ -97,18 +106,96 @@ if design_files and shirt_files:
     elif estimated_total_size > free * 0.8:
         st.sidebar.warning("⚠️ This batch may nearly fill your disk!")
 
+# --- Image Decoding ---
+# Not cached: pickled full-size RGBA bitmaps are tens of MB each, so decode per use instead
+def open_rgba(image_bytes):
+    return Image.open(io.BytesIO(image_bytes)).convert("RGBA")
+
 # --- Bounding Box Detection ---
-def get_shirt_bbox(pil_image):
-    img_cv = np.array(pil_image.convert("RGB"))[:, :, ::-1]
-    gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-    _, thresh = cv2.threshold(blurred, 240, 255, cv2.THRESH_BINARY_INV)
+# The bbox depends only on the shirt, so it is computed once per unique upload
+@st.cache_data(max_entries=64)
+def get_shirt_bbox(shirt_bytes):
+    pil_image = Image.open(io.BytesIO(shirt_bytes))
+    # the bbox doesn't need full resolution; detect on a ~512px wide copy and scale back up
+    scale_down = max(1, pil_image.width // 512)
+    small_size = (pil_image.width // scale_down, pil_image.height // scale_down)
+    # JPEG templates can be decoded straight to reduced-size luma; a no-op for other formats
+    pil_image.draft("L", small_size)
+    # PIL's luma conversion matches cv2's BGR2GRAY weights and gives OpenCV one contiguous uint8 plane
+    gray = np.asarray(pil_image.convert("L"))
+    if gray.shape[::-1] != small_size:
+        gray = cv2.resize(gray, small_size, interpolation=cv2.INTER_AREA)
+    _, thresh = cv2.threshold(gray, 240, 255, cv2.THRESH_BINARY_INV)
+    # a small opening drops anti-alias specks without the cost of a Gaussian blur
+    thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, np.ones((3, 3), np.uint8))
     contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     if contours:
         largest = max(contours, key=cv2.contourArea)
-        return cv2.boundingRect(largest)
+        x, y, w, h = cv2.boundingRect(largest)
+        return x * scale_down, y * scale_down, w * scale_down, h * scale_down
     return None
 
+# --- Mockup Compositing ---
+def place_design(design_size, shirt_size, bbox, padding_ratio, offset_pct):
+    design_width, design_height = design_size
+    if bbox:
+        sx, sy, sw, sh = bbox
+        scale = min(sw / design_width, sh / design_height, 1.0) * padding_ratio
+        # a tiny bbox or extreme aspect ratio must not round the design down to zero pixels
+        new_width = max(1, int(design_width * scale))
+        new_height = max(1, int(design_height * scale))
+        y_offset = int(sh * offset_pct / 100)
+        return (new_width, new_height), (sx + (sw - new_width) // 2, sy + y_offset)
+    return design_size, ((shirt_size[0] - design_width) // 2, (shirt_size[1] - design_height) // 2)
+
+def resize_design(design, size):
+    if size == design.size:
+        return design
+    # bilinear is indistinguishable from bicubic at mockup scale; reducing_gap shrinks large designs in two cheap steps
+    return design.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+
+# Past a handful of target sizes, resizing one premultiplied array with cv2 beats Pillow's per-call setup
+def resize_design_to_sizes(design, sizes):
+    if len(sizes) <= 4:
+        return {size: resize_design(design, size) for size in sizes}
+
+    # premultiply once, as Pillow does internally, so transparent pixels don't bleed into the edges
+    premultiplied = np.asarray(design.convert("RGBa"))
+    resized = {}
+    for size in sizes:
+        if size == design.size:
+            resized[size] = design
+            continue
+        # place_design never scales above 1.0, so every target is a shrink; INTER_AREA averages the
+        # whole source footprint like Pillow's widened bilinear, where INTER_LINEAR would alias
+        data = cv2.resize(premultiplied, size, interpolation=cv2.INTER_AREA)
+        resized[size] = Image.frombuffer("RGBa", size, data, "raw", "RGBa", 0, 1).convert("RGBA")
+    return resized
+
+def compose_mockup(resized_design, shirt, position):
+    x, y = position
+    mockup = shirt.copy()
+    # a design placed entirely off the canvas leaves the shirt untouched, as paste did
+    if x >= shirt.width or y >= shirt.height or x + resized_design.width <= 0 or y + resized_design.height <= 0:
+        return mockup
+    # alpha_composite only blends the design's region; it needs a non-negative dest, so crop the source instead
+    mockup.alpha_composite(resized_design, dest=(max(x, 0), max(y, 0)), source=(max(-x, 0), max(-y, 0)))
+    return mockup
+
+# Cached on the uploaded bytes so reruns triggered by unrelated widgets skip the composite + PNG encode
+@st.cache_data(max_entries=64)
+def render_pair(design_bytes, shirt_bytes, padding_ratio, offset_pct):
+    design = open_rgba(design_bytes)
+    shirt = open_rgba(shirt_bytes)
+    bbox = get_shirt_bbox(shirt_bytes)
+    size, position = place_design(design.size, shirt.size, bbox, padding_ratio, offset_pct)
+    mockup = compose_mockup(resize_design(design, size), shirt, position)
+    # the centered layout never shows more than ~1000px, so don't encode or ship the full template size
+    mockup.thumbnail((1024, 1024), Image.Resampling.BILINEAR)
+    buf = io.BytesIO()
+    mockup.save(buf, format="PNG", compress_level=1)
+    return buf.getvalue()
+
 # --- Live Preview ---
 if design_files and shirt_files:
     st.markdown("### 👀 Live Preview")
@@ -116,32 +203,11 @@ if design_files and shirt_files:
     selected_shirt = st.selectbox("Select a Shirt Template", shirt_files, format_func=lambda x: x.name)
 
     try:
-        selected_design.seek(0)
-        design = Image.open(selected_design).convert("RGBA")
-        selected_shirt.seek(0)
-        shirt = Image.open(selected_shirt).convert("RGBA")
-
         is_model = "model" in selected_shirt.name.lower()
         offset_pct = model_offset_pct if is_model else plain_offset_pct
         padding_ratio = model_padding_ratio if is_model else plain_padding_ratio
 
-        bbox = get_shirt_bbox(shirt)
-        if bbox:
-            sx, sy, sw, sh = bbox
-            scale = min(sw / design.width, sh / design.height, 1.0) * padding_ratio
-            new_width = int(design.width * scale)
-            new_height = int(design.height * scale)
-            resized_design = design.resize((new_width, new_height))
-            y_offset = int(sh * offset_pct / 100)
-            x = sx + (sw - new_width) // 2
-            y = sy + y_offset
-        else:
-            resized_design = design
-            x = (shirt.width - design.width) // 2
-            y = (shirt.height - design.height) // 2
-
-        preview = shirt.copy()
-        preview.paste(resized_design, (x, y), resized_design)
+        preview = render_pair(selected_design.getvalue(), selected_shirt.getvalue(), padding_ratio, offset_pct)
         st.image(preview, caption="📸 Live Mockup Preview", use_container_width=True)
     except Exception as e:
         st.error(f"⚠️ Preview failed: {e}")
@@ -161,6 +227,34 @@ def cleanup_on_exit():
 
 atexit.register(cleanup_on_exit)
 
+# --- Batch Worker ---
+# Decoded once per batch and shared by every design
+def prepare_shirt(shirt_file):
+    color_name = os.path.splitext(shirt_file.name)[0]
+    shirt_bytes = shirt_file.getvalue()
+    shirt = open_rgba(shirt_bytes)
+    bbox = get_shirt_bbox(shirt_bytes)
+
+    is_model = "model" in shirt_file.name.lower()
+    offset_pct = model_offset_pct if is_model else plain_offset_pct
+    padding_ratio = model_padding_ratio if is_model else plain_padding_ratio
+    return color_name, shirt, bbox, padding_ratio, offset_pct
+
+# PIL releases the GIL while compositing and encoding, so threads scale here
+def render_one(task):
+    resized_design, shirt, position, output_name = task
+    shirt_copy = compose_mockup(resized_design, shirt, position)
+
+    img_byte_arr = io.BytesIO()
+    if output_format == "WEBP":
+        # lossless at the fastest effort setting; encodes well ahead of PNG at a similar size
+        shirt_copy.save(img_byte_arr, format='WEBP', lossless=True, quality=0, method=0)
+    else:
+        # fast deflate: these PNGs are bundled into a zip for download, not archived
+        shirt_copy.save(img_byte_arr, format='PNG', compress_level=1, optimize=False)
+    # hand back a view of the encoded image rather than a bytes copy of it
+    return output_name, img_byte_arr.getbuffer()
+
 # --- Generate Mockups ---
 if st.button("🚀 Generate Mockups for Selected Batch", disabled=not enough_space):
     if not (selected_batch and shirt_files):
@@ -170,51 +264,35 @@ if st.button("🚀 Generate Mockups for Selected Batch", disabled=not enough_spa
         if "generated_zip" in st.session_state:
             safe_delete(st.session_state.generated_zip)
 
+        # cached decode and bbox lookups stay on the script thread, workers only receive the results
+        shirts_prepared = [prepare_shirt(shirt_file) for shirt_file in shirt_files]
+
         # Create new zip on disk
         with tempfile.NamedTemporaryFile(delete=False, suffix=".zip") as tmpfile:
-            with zipfile.ZipFile(tmpfile, "w", zipfile.ZIP_DEFLATED) as master_zipf:
+            with zipfile.ZipFile(tmpfile, "w", zipfile.ZIP_STORED) as master_zipf, \
+                    ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
                 for design_file in selected_batch:
                     graphic_name = st.session_state.design_names.get(design_file.name, "graphic")
-                    design_file.seek(0)
-                    design = Image.open(design_file).convert("RGBA")
-
-                    inner_zip_buffer = io.BytesIO()
-                    with zipfile.ZipFile(inner_zip_buffer, "w", zipfile.ZIP_DEFLATED) as zipf:
-                        for shirt_file in shirt_files:
-                            color_name = os.path.splitext(shirt_file.name)[0]
-                            shirt_file.seek(0)
-                            shirt = Image.open(shirt_file).convert("RGBA")
-
-                            is_model = "model" in shirt_file.name.lower()
-                            offset_pct = model_offset_pct if is_model else plain_offset_pct
-                            padding_ratio = model_padding_ratio if is_model else plain_padding_ratio
-
-                            bbox = get_shirt_bbox(shirt)
-                            if bbox:
-                                sx, sy, sw, sh = bbox
-                                scale = min(sw / design.width, sh / design.height, 1.0) * padding_ratio
-                                new_width = int(design.width * scale)
-                                new_height = int(design.height * scale)
-                                resized_design = design.resize((new_width, new_height))
-                                y_offset = int(sh * offset_pct / 100)
-                                x = sx + (sw - new_width) // 2
-                                y = sy + y_offset
-                            else:
-                                resized_design = design
-                                x = (shirt.width - design.width) // 2
-                                y = (shirt.height - design.height) // 2
-
-                            shirt_copy = shirt.copy()
-                            shirt_copy.paste(resized_design, (x, y), resized_design)
-
-                            output_name = f"{graphic_name}_{color_name}_tee.png"
-                            img_byte_arr = io.BytesIO()
-                            shirt_copy.save(img_byte_arr, format='PNG')
-                            img_byte_arr.seek(0)
-                            zipf.writestr(output_name, img_byte_arr.getvalue())
-
-                    inner_zip_buffer.seek(0)
-                    master_zipf.writestr(f"{graphic_name}.zip", inner_zip_buffer.read())
+                    design = open_rgba(design_file.getvalue())
+
+                    # shirts with the same bbox size share one resized copy of the design
+                    placements = [
+                        place_design(design.size, shirt.size, bbox, padding_ratio, offset_pct)
+                        for _, shirt, bbox, padding_ratio, offset_pct in shirts_prepared
+                    ]
+                    resized_by_size = resize_design_to_sizes(design, {size for size, _ in placements})
+                    tasks = [
+                        (resized_by_size[size], shirt, position, f"{graphic_name}_{color_name}_tee.{output_format.lower()}")
+                        for (color_name, shirt, *_), (size, position) in zip(shirts_prepared, placements)
+                    ]
+
+                    # render shirts in parallel; zipfile isn't thread-safe so writes stay on this thread
+                    # stream the per-design zip straight into its master entry instead of buffering it
+                    inner_info = zipfile.ZipInfo(f"{graphic_name}.zip", date_time=time.localtime()[:6])
+                    with master_zipf.open(inner_info, "w", force_zip64=True) as inner_zip_file, \
+                            zipfile.ZipFile(inner_zip_file, "w", zipfile.ZIP_STORED) as zipf:
+                        for output_name, data in executor.map(render_one, tasks):
+                            zipf.writestr(output_name, data)
 
             tmpfile_path = tmpfile.name
             st.session_state.generated_zip = tmpfile_path  # store path